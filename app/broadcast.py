@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from collections.abc import Generator
+
+# 購読者ごとの通知キュー（変更のあった download_id が積まれる）
+_subscribers: set[asyncio.Queue[int]] = set()
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def bind_loop(loop: asyncio.AbstractEventLoop | None) -> None:
+    """別スレッドからの通知を受け付けるイベントループを登録する（Noneで解除）。"""
+    global _loop
+    _loop = loop
+
+
+def publish(download_id: int) -> None:
+    """変更のあった download_id を全購読者へ通知する。イベントループ上から呼ぶこと。"""
+    for queue in _subscribers:
+        queue.put_nowait(download_id)
+
+
+def publish_threadsafe(download_id: int) -> None:
+    """ダウンロードスレッドなど、イベントループ外から通知する。"""
+    loop = _loop
+    if loop is None:
+        return
+    # シャットダウン中でループが閉じている場合は通知を捨てる
+    with contextlib.suppress(RuntimeError):
+        loop.call_soon_threadsafe(publish, download_id)
+
+
+@contextlib.contextmanager
+def subscribe() -> Generator[asyncio.Queue[int]]:
+    """通知キューを購読する。ブロックを抜けると購読を解除する。"""
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    _subscribers.add(queue)
+    try:
+        yield queue
+    finally:
+        _subscribers.discard(queue)
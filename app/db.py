@@ -1,8 +1,17 @@
 from __future__ import annotations
 
+import asyncio
+import logging
+import queue
 import sqlite3
+from collections.abc import AsyncGenerator, Generator
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
 
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
 ROOT_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = ROOT_DIR / "data"
 DB_PATH = DATA_DIR / "webui.db"
@@ -26,22 +35,186 @@ CREATE TABLE IF NOT EXISTS downloads (
     created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
+-- ステータス絞り込み（キュー待ち/ダウンロード中の検索）を新しい順で引くためのインデックス
+-- ※ ORDER BY id DESC のみのクエリは INTEGER PRIMARY KEY(rowid) の逆順走査で足りる
+CREATE INDEX IF NOT EXISTS idx_downloads_status_id ON downloads(status, id DESC);
 """
 
 
-def get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# 接続ごとに適用するPRAGMA（busy_timeout は他の文より先に設定する）
+# ※ journal_mode = WAL はDBファイルに永続化されるため init_db() で1回だけ設定する
+_PRAGMAS = (
+    "PRAGMA busy_timeout = 30000;",
+    # WALではNORMALでも整合性は保たれる（fsyncはチェックポイント時のみ）
+    "PRAGMA synchronous = NORMAL;",
+    # 進捗更新でWALが伸びても読み取り側でチェックポイントが走りにくいよう閾値を上げる（定期的にTRUNCATEする）
+    "PRAGMA wal_autocheckpoint = 10000;",
+    "PRAGMA journal_size_limit = 67108864;",  # 64 MiB
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA mmap_size = 268435456;",  # 256 MiB
+    "PRAGMA cache_size = -65536;",  # 64 MiB
+    "PRAGMA foreign_keys = ON;",
+)
+
+
+def get_connection(*, check_same_thread: bool = True) -> sqlite3.Connection:
+    # 暗黙のトランザクションも BEGIN IMMEDIATE で開始し、書き込みロックを先に確保する
+    conn = sqlite3.connect(DB_PATH, isolation_level="IMMEDIATE", check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA busy_timeout = 5000;")
-    conn.execute("PRAGMA journal_mode = WAL;")
-    conn.execute("PRAGMA foreign_keys = ON;")
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+# ダウンロードスレッド用の同期コネクションのプール。空なら新しく開き、使い終わったら戻す
+# （同時に借りられる数＝同時実行中のダウンロード数なので上限は設けない）
+_SYNC_POOL: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+
+
+@contextmanager
+def pooled_connection() -> Generator[sqlite3.Connection]:
+    """プールから同期コネクションを借りる。スレッドをまたいで使い回すため check_same_thread=False で開く。"""
+    try:
+        conn = _SYNC_POOL.get_nowait()
+    except queue.Empty:
+        conn = get_connection(check_same_thread=False)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _SYNC_POOL.put(conn)
+
+
+def close_connection_pool() -> None:
+    """プールに戻っている同期コネクションをすべて閉じる。"""
+    while True:
+        try:
+            _SYNC_POOL.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+# 書き込み用の共有非同期コネクション（プロセス内で1本だけ開いて使い回す）
+_ASYNC_CONN: aiosqlite.Connection | None = None
+_ASYNC_CONN_LOCK = asyncio.Lock()
+# 共有コネクション上のトランザクションはコルーチン間で直列化する
+_TX_LOCK = asyncio.Lock()
+
+
+async def get_async_conn() -> aiosqlite.Connection:
+    """共有の非同期コネクションを返す。初回呼び出し時のみ接続してPRAGMAを設定する。"""
+    global _ASYNC_CONN
+    if _ASYNC_CONN is None:
+        async with _ASYNC_CONN_LOCK:
+            if _ASYNC_CONN is None:
+                # isolation_level=None: 自動コミット。書き込みは transaction() で明示的に囲む
+                conn = await aiosqlite.connect(DB_PATH, isolation_level=None)
+                conn.row_factory = aiosqlite.Row
+                for pragma in _PRAGMAS:
+                    await conn.execute(pragma)
+                _ASYNC_CONN = conn
+    return _ASYNC_CONN
+
+
+@asynccontextmanager
+async def transaction() -> AsyncGenerator[aiosqlite.Connection]:
+    """共有コネクション上で BEGIN IMMEDIATE ～ COMMIT を実行する。例外時はROLLBACK。"""
+    conn = await get_async_conn()
+    async with _TX_LOCK:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+        await conn.execute("COMMIT")
+
+
+# 読み取り専用コネクションのプール（WALでは書き込み中も並行して読める）
+READER_POOL_SIZE = 4
+_READERS: asyncio.Queue[aiosqlite.Connection] | None = None
+
+
+async def _get_readers() -> asyncio.Queue[aiosqlite.Connection]:
+    """読み取り用プールを返す。初回呼び出し時のみ READER_POOL_SIZE 本を接続する。"""
+    global _READERS
+    if _READERS is None:
+        async with _ASYNC_CONN_LOCK:
+            if _READERS is None:
+                readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+                for _ in range(READER_POOL_SIZE):
+                    conn = await aiosqlite.connect(f"{DB_PATH.as_uri()}?mode=ro", uri=True)
+                    conn.row_factory = aiosqlite.Row
+                    for pragma in _PRAGMAS:
+                        await conn.execute(pragma)
+                    readers.put_nowait(conn)
+                _READERS = readers
+    return _READERS
+
+
+@asynccontextmanager
+async def reader() -> AsyncGenerator[aiosqlite.Connection]:
+    """読み取り専用コネクションをプールから借り、抜けるときに返却する。"""
+    readers = await _get_readers()
+    conn = await readers.get()
+    try:
+        yield conn
+    finally:
+        readers.put_nowait(conn)
+
+
+async def close_async_conn() -> None:
+    """共有コネクションと読み取り用プールを閉じる。閉じる前に PRAGMA optimize で統計情報を更新する。"""
+    global _ASYNC_CONN, _READERS
+    async with _ASYNC_CONN_LOCK:
+        if _READERS is not None:
+            while not _READERS.empty():
+                await _READERS.get_nowait().close()
+            _READERS = None
+        if _ASYNC_CONN is not None:
+            async with _TX_LOCK:
+                await _ASYNC_CONN.execute("PRAGMA optimize;")
+            await _ASYNC_CONN.close()
+            _ASYNC_CONN = None
+
+
+async def optimize_periodically(interval: float = 3600) -> None:
+    """一定間隔で PRAGMA optimize を実行し、クエリプランナの統計情報を最新に保つ。"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            conn = await get_async_conn()
+            # 他のコルーチンのトランザクション中に割り込まないよう、トランザクションと同じロック下で実行する
+            async with _TX_LOCK:
+                await conn.execute("PRAGMA optimize;")
+        except Exception:
+            # 1回の失敗で定期実行が止まらないようにする
+            logger.exception("PRAGMA optimize failed")
+
+
+async def checkpoint_periodically(interval: float = 300) -> None:
+    """一定間隔でWALをチェックポイントし、WALファイルを切り詰めてサイズを抑える。"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            conn = await get_async_conn()
+            # トランザクション中のコネクションではチェックポイントできない（database table is locked）ため、ロック下で実行する
+            async with _TX_LOCK:
+                await conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        except Exception:
+            # 1回の失敗で定期実行が止まらないようにする
+            logger.exception("WAL checkpoint failed")
+
+
 async def init_db() -> None:  # noqa: RUF029
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
     with get_connection() as conn:
+        # WALモードへ切り替え（DBファイルに記録され、以降の接続にも適用される）
+        conn.execute("PRAGMA journal_mode = WAL;")
+
         # テーブル作成
         conn.executescript(SCHEMA_SQL)
 
@@ -51,4 +224,15 @@ async def init_db() -> None:  # noqa: RUF029
         if "yt_dlp_params" not in columns:
             conn.execute("ALTER TABLE downloads ADD COLUMN yt_dlp_params TEXT")
 
+        # 前回プロセスで未完了のまま残った行は実行されないため、エラーとして再試行できるようにする
+        conn.execute(
+            "UPDATE downloads SET status = 'error', error_message = ?, updated_at = CURRENT_TIMESTAMP WHERE status IN ('queued', 'downloading')",
+            ("サーバーの再起動により中断されました。",),
+        )
+        # 同じURL・種別の未完了ダウンロードは1件まで（重複登録の防止）
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_downloads_active_url_type ON downloads(url, download_type) WHERE status IN ('queued', 'downloading')")
+
         conn.commit()
+
+        # 起動時に統計情報を更新（0x10000: 全テーブルを対象に必要なものだけANALYZE）
+        conn.execute("PRAGMA optimize = 0x10002;")
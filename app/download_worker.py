@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
+from app.routers.utils import run_download_task
+
+logger = logging.getLogger(__name__)
+
+# 同時に実行するダウンロード数（ワーカー数）。環境変数 DOWNLOAD_CONCURRENCY で変更できる
+DOWNLOAD_CONCURRENCY = max(1, int(os.environ.get("DOWNLOAD_CONCURRENCY", "1")))
+
+# (download_id, url, download_type, force_redownload, yt_dlp_params)
+DownloadJob = tuple[int, str, str, bool, str | None]
+
+# 同じIDのジョブ（実行待ち中の再試行など）が別ワーカーで並行しないよう、IDごとにロックする
+_id_locks: dict[int, asyncio.Lock] = {}
+_id_lock_users: dict[int, int] = {}
+
+
+@asynccontextmanager
+async def _lock_download_id(download_id: int) -> AsyncGenerator[None]:
+    """IDごとのロックを取得する。待ち手がいなくなったロックは破棄する。"""
+    lock = _id_locks.setdefault(download_id, asyncio.Lock())
+    _id_lock_users[download_id] = _id_lock_users.get(download_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _id_lock_users[download_id] -= 1
+        if not _id_lock_users[download_id]:
+            del _id_lock_users[download_id]
+            del _id_locks[download_id]
+
+
+async def run_download_worker(queue: asyncio.Queue[DownloadJob]) -> None:
+    """キューからジョブを1件ずつ取り出し、スレッド上でダウンロードを実行する常駐タスク。
+
+    DOWNLOAD_CONCURRENCY 個を起動して同じキューを共有する。
+    """
+    while True:
+        job = await queue.get()
+        try:
+            async with _lock_download_id(job[0]):
+                await asyncio.to_thread(run_download_task, *job)
+        except Exception:
+            # 1件の失敗でワーカーが止まらないようにする
+            logger.exception("download task failed: id=%s", job[0])
+        finally:
+            queue.task_done()
@@ -1,38 +1,46 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import logging
 import os
 import secrets
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from .db import init_db
+from .broadcast import bind_loop
+from .db import checkpoint_periodically, close_async_conn, close_connection_pool, get_async_conn, init_db, optimize_periodically
+from .download_worker import DOWNLOAD_CONCURRENCY, DownloadJob, run_download_worker
+from .progress_writer import flush_progress, run_progress_writer
 from .routers.downloads import router as downloads_router
 
+logger = logging.getLogger(__name__)
+
 security = HTTPBasic()
 
+# 認証情報は起動時に一度だけ環境変数から読み込む（比較用にbytesで保持）
+_USERNAME = os.getenv("USERNAME", "").encode()
+_PASSWORD = os.getenv("PASSWORD", "").encode()
 
-async def verify_username(request: Request) -> HTTPBasicCredentials:
-    # 環境変数から認証情報を取得
-    env_username = os.getenv("USERNAME")
-    env_password = os.getenv("PASSWORD")
 
+async def verify_username(request: Request) -> HTTPBasicCredentials:
     # 環境変数が設定されていない場合はエラー
-    if not env_username or not env_password:
+    if not _USERNAME or not _PASSWORD:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="USERNAME or PASSWORD environment variable is not set",
         )
 
     credentials = await security(request)
-    correct_username = secrets.compare_digest(credentials.username, env_username)
-    correct_password = secrets.compare_digest(credentials.password, env_password)
-    if not (correct_username and correct_password):
+    correct_username = secrets.compare_digest(credentials.username.encode(), _USERNAME)
+    correct_password = secrets.compare_digest(credentials.password.encode(), _PASSWORD)
+    if not (correct_username & correct_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect name or password",
@@ -42,15 +50,41 @@ async def verify_username(request: Request) -> HTTPBasicCredentials:
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
-    """アプリ起動時にDBと保存先ディレクトリを初期化する。"""
+async def lifespan(fastapi_app: FastAPI) -> AsyncGenerator[None]:
+    """アプリ起動時にDBと保存先ディレクトリを初期化し、常駐タスク（ダウンロードワーカー・定期メンテナンス・進捗ライター）と変更通知を開始する。終了時に共有コネクションを閉じる。"""
     await init_db()
-    yield
+    _render_index(fastapi_app)
+    await get_async_conn()
+    bind_loop(asyncio.get_running_loop())
+    download_queue: asyncio.Queue[DownloadJob] = asyncio.Queue()
+    fastapi_app.state.download_queue = download_queue
+    tasks = [
+        *(asyncio.create_task(run_download_worker(download_queue)) for _ in range(DOWNLOAD_CONCURRENCY)),
+        asyncio.create_task(optimize_periodically()),
+        asyncio.create_task(checkpoint_periodically()),
+        asyncio.create_task(run_progress_writer()),
+    ]
+    try:
+        yield
+    finally:
+        try:
+            for task in tasks:
+                task.cancel()
+            # 停止前に異常終了していたタスクの例外も拾ってログに残す（後片付けは必ず行う）
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("background task failed", exc_info=result)
+            await flush_progress()
+        finally:
+            bind_loop(None)
+            await close_async_conn()
+            close_connection_pool()
 
 
 app = FastAPI(
     title="YouTube ダウンロード WebUI",
-    summary="yt-dlp を用いて動画/音声を1並列でダウンロードするシンプルな Web UI",
+    summary="yt-dlp を用いて動画/音声をダウンロードするシンプルな Web UI（既定は1並列）",
     description="YouTube などの動画 URL を登録し、バックグラウンドでダウンロードを実行。履歴管理・進捗表示・保存/再試行に対応。",
     version="1.0.0",
     openapi_tags=[
@@ -60,6 +94,8 @@ app = FastAPI(
         },
     ],
     lifespan=lifespan,
+    # JSONエンコードはorjsonで行う（標準のjsonより高速）
+    default_response_class=ORJSONResponse,
 )
 
 # 静的ファイルとテンプレートの設定
@@ -69,18 +105,31 @@ templates = Jinja2Templates(directory="templates")
 app.include_router(downloads_router)
 
 
+def _render_index(fastapi_app: FastAPI) -> None:
+    """トップページは動的な値を含まないため、起動時に一度だけ描画してETagと共に保持する。"""
+    html = templates.get_template("index.html").render(
+        request=None,
+        url_for=fastapi_app.url_path_for,
+        download_concurrency=DOWNLOAD_CONCURRENCY,
+    )
+    fastapi_app.state.index_html = html.encode()
+    fastapi_app.state.index_etag = f'"{hashlib.blake2b(fastapi_app.state.index_html, digest_size=8).hexdigest()}"'
+
+
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request) -> HTMLResponse:
-    """トップページ: Jinja2テンプレートを返す。"""
+async def root(request: Request) -> Response:
+    """トップページ: 起動時に描画済みのHTMLを返す（ETagが一致すれば304）。"""
     # ベーシック認証を適用
     await verify_username(request)
-    return templates.TemplateResponse(
-        name="index.html",
-        context={"request": request},
-    )
+    etag = request.app.state.index_etag
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=60"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return HTMLResponse(request.app.state.index_html, headers=headers)
 
 
 @app.get("/health")
-async def health() -> dict[str, str]:
-    """ヘルスチェック用エンドポイント。"""
-    return {"status": "ok"}
+async def health(request: Request) -> dict[str, str | int]:
+    """ヘルスチェック用エンドポイント。実行待ちのダウンロード件数も返す。"""
+    return {"status": "ok", "queue_depth": request.app.state.download_queue.qsize()}
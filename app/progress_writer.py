@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+
+from app.broadcast import publish
+from app.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# 未反映の進捗（download_id -> (progress, file_size)）。同じIDは最新値で上書きする
+_pending: dict[int, tuple[int, int]] = {}
+_pending_lock = threading.Lock()
+
+
+def report_progress(download_id: int, progress: int, file_size: int) -> None:
+    """進捗を書き込み待ちとして登録する。ダウンロードスレッドから呼ばれる想定。"""
+    with _pending_lock:
+        _pending[download_id] = (progress, file_size)
+
+
+def _take_pending() -> dict[int, tuple[int, int]]:
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, {}
+    return pending
+
+
+async def flush_progress() -> None:
+    """溜まっている進捗を1トランザクションでまとめてDBに反映する。"""
+    pending = _take_pending()
+    if not pending:
+        return
+    try:
+        async with transaction() as conn:
+            # 完了/エラーへ遷移済みの行は上書きしない
+            await conn.executemany(
+                "UPDATE downloads SET progress = ?, file_size = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'downloading'",
+                [(progress, file_size, download_id) for download_id, (progress, file_size) in pending.items()],
+            )
+    except BaseException:
+        # 書き込めなかった進捗は次回に回す（その間に届いた新しい値があればそちらを優先）
+        with _pending_lock:
+            for download_id, value in pending.items():
+                _pending.setdefault(download_id, value)
+        raise
+    for download_id in pending:
+        publish(download_id)
+
+
+async def run_progress_writer(interval: float = 0.1) -> None:
+    """一定間隔（interval 秒）ごとに進捗をまとめて書き込む常駐タスク。"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_progress()
+        except Exception:
+            # 1回の書き込み失敗で進捗の反映・通知が止まらないようにする（未反映分は次回まとめて書き込む）
+            logger.exception("progress flush failed")
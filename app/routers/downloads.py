@@ -1,19 +1,30 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import pathlib
-from typing import Any
+import sqlite3
+from collections.abc import AsyncIterator
+from datetime import datetime
+from stat import S_ISREG
+from typing import Annotated, Any, Literal
 from urllib.parse import quote
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException, status
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, HTTPException, Query, Request, status
+from fastapi.responses import FileResponse, Response
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
+from pydantic_core import PydanticCustomError
+from sse_starlette import EventSourceResponse
+from sse_starlette.sse import AppStatus
 
-from app.db import get_connection
+from app.broadcast import publish, subscribe
+from app.db import reader, transaction
 from app.routers.utils import (
+    DOWNLOAD_COLUMNS,
+    is_http_url,
     row_to_dict,
-    run_download_task,
-    validate_download_type,
-    validate_url,
+    rows_to_dicts,
+    validate_not_playlist,
 )
 
 
@@ -28,6 +39,8 @@ class DownloadItem(BaseModel):
     error_message: str | None = None
     title: str | None = None
     yt_dlp_params: str | None = None
+    created_at: datetime
+    updated_at: datetime
 
     model_config = {
         "json_schema_extra": {
@@ -43,12 +56,18 @@ class DownloadItem(BaseModel):
                     "error_message": None,
                     "title": "Example Video",
                     "yt_dlp_params": "--write-thumbnail",
+                    "created_at": "2025-01-01T12:00:00",
+                    "updated_at": "2025-01-01T12:05:00",
                 }
             ]
         }
     }
 
 
+# 一覧のシリアライズ用（スキーマを一度だけ構築して使い回す）
+_DOWNLOAD_LIST_ADAPTER = TypeAdapter(list[DownloadItem])
+
+
 class ErrorResponse(BaseModel):
     detail: str
 
@@ -64,9 +83,16 @@ class ErrorResponse(BaseModel):
 
 class CreateDownloadRequest(BaseModel):
     url: str = Field(..., description="ダウンロード対象のURL")
-    download_type: str = Field(..., description="ダウンロード種別 (video または audio)")
+    download_type: Literal["video", "audio"] = Field(..., description="ダウンロード種別 (video または audio)")
     yt_dlp_params: str | None = Field(None, description="yt-dlpに追加で渡すパラメータ")
 
+    @field_validator("url")
+    @classmethod
+    def _validate_url(cls, url: str) -> str:
+        if not is_http_url(url):
+            raise PydanticCustomError("url_invalid", "URLが不正です。http(s):// で始まる有効なURLを指定してください。")
+        return url
+
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -80,26 +106,100 @@ class CreateDownloadRequest(BaseModel):
     }
 
 
+class _LargeChunkFileResponse(FileResponse):
+    # ゼロコピー送信できないサーバーではチャンク単位で読み出すため、既定の64KiBより大きく取る
+    chunk_size = 1024 * 1024
+
+
 router = APIRouter(prefix="/api/downloads", tags=["downloads"])
 
 
+@functools.lru_cache(maxsize=1024)
+def _content_disposition(file_path: str) -> str:
+    """ファイルパスからContent-Dispositionヘッダ値を作る（パスごとに不変なのでキャッシュする）。
+
+    ファイルの存在確認は削除・再試行で変わり得るためキャッシュせず、毎回行う。
+    """
+    encoded_filename = quote(pathlib.Path(file_path).name)
+    return f"attachment; filename*=UTF-8''{encoded_filename}"
+
+
 @router.get(
     "",
     summary="ダウンロード履歴一覧取得",
-    description="登録済みのダウンロード履歴を新しい順に返します。",
+    description="登録済みのダウンロード履歴を新しい順に返します。`before_id` を指定すると、そのIDより古い履歴を `limit` 件まで返します（キーセットページング）。",
     response_model=list[DownloadItem],
     response_description="ダウンロード履歴のリスト",
     responses={
         200: {"description": "成功時", "model": list[DownloadItem]},
     },
 )
-def list_downloads() -> list[dict[str, Any]]:
-    """履歴一覧を新しい順で返す。"""
-    with get_connection() as conn:
-        rows = conn.execute(
-            "SELECT * FROM downloads ORDER BY id DESC",
-        ).fetchall()
-    return [row_to_dict(r) for r in rows]
+async def list_downloads(
+    limit: Annotated[int, Query(ge=1, le=500, description="取得件数の上限")] = 50,
+    before_id: Annotated[int | None, Query(description="このIDより古い履歴を返す（前ページの最小ID）")] = None,
+) -> Response:
+    """履歴一覧を新しい順で返す。主キーの逆順走査で limit 件だけ読む。"""
+    async with reader() as conn:
+        if before_id is None:
+            rows = await conn.execute_fetchall(
+                f"SELECT {DOWNLOAD_COLUMNS} FROM downloads ORDER BY id DESC LIMIT ?",
+                (limit,),
+            )
+        else:
+            rows = await conn.execute_fetchall(
+                f"SELECT {DOWNLOAD_COLUMNS} FROM downloads WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (before_id, limit),
+            )
+    # 検証とJSON化をpydantic-coreで一括して行い、FastAPI側の再検証・再エンコードを省く
+    items = _DOWNLOAD_LIST_ADAPTER.validate_python(rows_to_dicts(rows))
+    return Response(_DOWNLOAD_LIST_ADAPTER.dump_json(items), media_type="application/json")
+
+
+async def _change_events() -> AsyncIterator[str | dict[str, str]]:
+    """変更通知を受けるたびに、変更された行のリストをSSEのdataとして送る。
+
+    購読開始直後に `ready` イベントを送る。クライアントはこれを受けてから一覧を取得すれば、
+    取得以降の変更を取りこぼさない。
+    """
+    with subscribe() as queue:
+        yield {"event": "ready", "data": ""}
+        while True:
+            try:
+                download_id = await asyncio.wait_for(queue.get(), timeout=1)
+            except TimeoutError:
+                # サーバー停止時は接続を閉じる（開いたままだと停止処理が待たされる）
+                if AppStatus.should_exit:
+                    return
+                continue
+            # 溜まっている通知もまとめて1回のクエリで取得する
+            ids = {download_id}
+            while not queue.empty():
+                ids.add(queue.get_nowait())
+            placeholders = ", ".join("?" * len(ids))
+            # 接続は問い合わせの間だけ借りる（ストリームの間ずっと占有しない）
+            async with reader() as conn:
+                rows = await conn.execute_fetchall(
+                    f"SELECT {DOWNLOAD_COLUMNS} FROM downloads WHERE id IN ({placeholders}) ORDER BY id DESC",
+                    tuple(ids),
+                )
+            if rows:
+                items = _DOWNLOAD_LIST_ADAPTER.validate_python(rows_to_dicts(rows))
+                yield _DOWNLOAD_LIST_ADAPTER.dump_json(items).decode()
+
+
+@router.get(
+    "/stream",
+    summary="ダウンロード状態の変更通知",
+    description="Server-Sent Events で、状態や進捗が変化したダウンロード情報のリストを都度送信します。",
+    response_class=EventSourceResponse,
+    responses={
+        200: {"description": "`text/event-stream`。購読開始時に `ready` イベントを送り、以降の各イベントの data は変更された行のリスト(JSON)"},
+    },
+)
+async def stream_downloads() -> EventSourceResponse:
+    """変更のあった行をSSEでプッシュする。"""
+    # プロキシに切断されないよう15秒ごとにpingを送る
+    return EventSourceResponse(_change_events(), ping=15)
 
 
 @router.get(
@@ -112,31 +212,25 @@ def list_downloads() -> list[dict[str, Any]]:
         404: {"description": "指定されたIDが存在しない場合", "model": ErrorResponse},
     },
 )
-def get_download(download_id: int) -> dict[str, Any]:
+async def get_download(download_id: int) -> dict[str, Any]:
     """単一エントリ取得。"""
-    with get_connection() as conn:
-        row = conn.execute(
-            "SELECT * FROM downloads WHERE id = ?",
+    async with reader() as conn:
+        cursor = await conn.execute(
+            f"SELECT {DOWNLOAD_COLUMNS} FROM downloads WHERE id = ?",
             (download_id,),
-        ).fetchone()
+        )
+        row = await cursor.fetchone()
     if not row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
     return row_to_dict(row)
 
 
-def _file_iterator(file_path: str, chunk_size: int = 8192) -> iter[bytes]:
-    """ファイルをチャンク単位で読み込むジェネレータ関数。"""
-    with open(file_path, "rb") as file:
-        while chunk := file.read(chunk_size):
-            yield chunk
-
-
 @router.get(
     "/{download_id}/download",
     summary="ダウンロードファイル取得",
     description="指定されたIDのダウンロード済みファイルを返します。`status` が `completed` の場合のみ取得可能です。",
     responses={
-        200: {"description": "ファイルストリームを返します"},
+        200: {"description": "ファイルを返します"},
         400: {
             "description": "ダウンロードが完了していない場合",
             "model": ErrorResponse,
@@ -147,13 +241,14 @@ def _file_iterator(file_path: str, chunk_size: int = 8192) -> iter[bytes]:
         },
     },
 )
-def download_file(download_id: int) -> StreamingResponse:
+async def download_file(download_id: int) -> FileResponse:
     """指定されたIDのダウンロード済みファイルをクライアントに送信する。"""
-    with get_connection() as conn:
-        row = conn.execute(
-            "SELECT * FROM downloads WHERE id = ?",
+    async with reader() as conn:
+        cursor = await conn.execute(
+            "SELECT status, file_path FROM downloads WHERE id = ?",
             (download_id,),
-        ).fetchone()
+        )
+        row = await cursor.fetchone()
     if not row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
 
@@ -164,25 +259,27 @@ def download_file(download_id: int) -> StreamingResponse:
         )
 
     file_path = row["file_path"]
-    print(file_path)
-    if not file_path or not pathlib.Path(file_path).exists():
+    # 存在確認（通常ファイルか）とサイズ取得を1回のstatで行い、結果をFileResponseへ渡して再statを省く
+    try:
+        stat_result = await asyncio.to_thread(pathlib.Path(file_path).stat) if file_path else None
+    except OSError:
+        stat_result = None
+    if stat_result is None or not S_ISREG(stat_result.st_mode):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="ファイルが見つかりません。",
         )
 
-    filename = pathlib.Path(file_path).name
-    encoded_filename = quote(filename)
-    file_size = row["file_size"]
     headers = {
-        "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_filename}",
-        "Content-Type": "application/octet-stream",
-        "Content-Length": str(file_size),
+        "Content-Disposition": _content_disposition(file_path),
     }
 
-    return StreamingResponse(
-        _file_iterator(file_path),
+    # Content-Length はstat結果から設定され、Range対応はFileResponseに任せる
+    return _LargeChunkFileResponse(
+        file_path,
+        media_type="application/octet-stream",
         headers=headers,
+        stat_result=stat_result,
     )
 
 
@@ -195,81 +292,81 @@ def download_file(download_id: int) -> StreamingResponse:
         200: {"description": "再試行開始後のダウンロード情報", "model": DownloadItem},
         404: {"description": "指定されたIDが存在しない場合", "model": ErrorResponse},
         409: {
-            "description": "ダウンロード中は再試行できません",
+            "description": "ダウンロード中、または同じURL・形式のダウンロードが実行待ち/実行中のため再試行できない場合",
             "model": ErrorResponse,
         },
     },
 )
-def retry_download(download_id: int, background_tasks: BackgroundTasks) -> dict[str, Any]:
+async def retry_download(download_id: int, request: Request) -> dict[str, Any]:
     """ダウンロードの再試行（最初からやり直す）。
 
     - ダウンロード中以外の全ステータスで実行可能（completedも可）
     - 進捗/ファイル情報/エラー/タイトルを初期化しqueueへ戻す
-    - 実行はバックグラウンドでforce_redownload=Trueとして再実行
+    - 実行はダウンロードキュー経由でforce_redownload=Trueとして再実行
     """
-    with get_connection() as conn:
-        row = conn.execute(
-            "SELECT * FROM downloads WHERE id = ?",
-            (download_id,),
-        ).fetchone()
+    async with transaction() as conn:
+        # 状態を初期化してキューへ戻す（最初から）。ダウンロード中の行は対象外
+        try:
+            cursor = await conn.execute(
+                f"""
+                UPDATE downloads
+                   SET status = 'queued',
+                       progress = 0,
+                       file_size = 0,
+                       file_path = NULL,
+                       error_message = NULL,
+                       title = NULL,
+                       updated_at = CURRENT_TIMESTAMP
+                 WHERE id = ? AND status != 'downloading'
+                RETURNING {DOWNLOAD_COLUMNS}
+                """,
+                (download_id,),
+            )
+            row = await cursor.fetchone()
+        except sqlite3.IntegrityError as e:
+            # 同じURL・種別の別の行が未完了（一意インデックス違反）
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="同じURL・形式のダウンロードが既に実行待ちまたは実行中です。",
+            ) from e
 
         if not row:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
-
-        if row["status"] == "downloading":
+            # 更新できなかった場合のみ、存在しないのかダウンロード中なのかを判定する
+            cursor = await conn.execute(
+                "SELECT status FROM downloads WHERE id = ?",
+                (download_id,),
+            )
+            if not await cursor.fetchone():
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail="ダウンロード中は再試行できません。",
             )
 
-        # 状態を初期化してキューへ戻す（最初から）
-        conn.execute(
-            """
-            UPDATE downloads
-               SET status = 'queued',
-                   progress = 0,
-                   file_size = 0,
-                   file_path = NULL,
-                   error_message = NULL,
-                   title = NULL,
-                   updated_at = CURRENT_TIMESTAMP
-             WHERE id = ?
-            """,
-            (download_id,),
-        )
-        conn.commit()
-
-        # バックグラウンド実行（強制再ダウンロード）
-        background_tasks.add_task(
-            run_download_task,
-            download_id,
-            row["url"],
-            row["download_type"],
-            True,
-            row["yt_dlp_params"],
-        )
+    publish(download_id)
 
-        row2 = conn.execute(
-            "SELECT * FROM downloads WHERE id = ?",
-            (download_id,),
-        ).fetchone()
+    # ダウンロードキューへ投入（強制再ダウンロード）
+    await request.app.state.download_queue.put((download_id, row["url"], row["download_type"], True, row["yt_dlp_params"]))
 
-    return row_to_dict(row2)
+    return row_to_dict(row)
 
 
 @router.post(
     "",
     summary="新規ダウンロード登録",
-    description="新しいダウンロードを登録し、バックグラウンドで実行を開始します。",
+    description="新しいダウンロードを登録し、ダウンロードキューに投入します。",
     status_code=status.HTTP_201_CREATED,
     response_model=DownloadItem,
     responses={
+        200: {"description": "同じURL・形式のダウンロードが実行待ちまたは実行中の場合、その既存のダウンロード情報", "model": DownloadItem},
         201: {"description": "登録成功時のダウンロード情報", "model": DownloadItem},
-        422: {"description": "入力値が不正な場合", "model": ErrorResponse},
+        400: {"description": "プレイリストURLが指定された場合", "model": ErrorResponse},
     },
 )
-def create_download(payload: CreateDownloadRequest, background_tasks: BackgroundTasks) -> dict[str, Any]:
-    """新規ダウンロードの登録（DBにqueuedで作成）し、バックグラウンドで実行を開始する。
+async def create_download(payload: CreateDownloadRequest, request: Request, response: Response) -> dict[str, Any]:
+    """新規ダウンロードの登録（DBにqueuedで作成）し、ダウンロードキューに投入する。
+
+    同じURL・形式が実行待ち/実行中なら新規登録せず、既存の行を200で返す。
 
     Body:
       {
@@ -278,41 +375,39 @@ def create_download(payload: CreateDownloadRequest, background_tasks: Background
         "yt_dlp_params": "--write-thumbnail"
       }
     """
-    url: str | None = payload.url
-    download_type: str | None = payload.download_type
-    yt_dlp_params: str | None = payload.yt_dlp_params
-
-    if not url or not isinstance(url, str):
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="url は必須です。",
-        )
-    if not download_type or not isinstance(download_type, str):
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="download_type は必須です。",
-        )
-
-    validate_url(url)
-    validate_download_type(download_type)
-
-    with get_connection() as conn:
-        cur = conn.execute(
-            """
+    # 形式・種別はリクエストモデルで検証済み。プレイリスト未対応の判定のみここで行う
+    url = payload.url
+    download_type = payload.download_type
+    yt_dlp_params = payload.yt_dlp_params
+    validate_not_playlist(url)
+
+    async with transaction() as conn:
+        # 未完了の同一URL・形式があれば一意インデックスにより挿入されない
+        cursor = await conn.execute(
+            f"""
             INSERT INTO downloads (url, download_type, status, yt_dlp_params)
             VALUES (?, ?, 'queued', ?)
+            ON CONFLICT DO NOTHING
+            RETURNING {DOWNLOAD_COLUMNS}
             """,
             (url, download_type, yt_dlp_params),
         )
-        new_id = cur.lastrowid
-        conn.commit()
+        row = await cursor.fetchone()
+        if not row:
+            cursor = await conn.execute(
+                f"SELECT {DOWNLOAD_COLUMNS} FROM downloads WHERE url = ? AND download_type = ? AND status IN ('queued', 'downloading')",
+                (url, download_type),
+            )
+            existing = await cursor.fetchone()
+
+    if not row:
+        # 既存の行を返すだけで、キューには再投入しない
+        response.status_code = status.HTTP_200_OK
+        return row_to_dict(existing)
 
-        row = conn.execute(
-            "SELECT * FROM downloads WHERE id = ?",
-            (new_id,),
-        ).fetchone()
+    publish(row["id"])
 
-    # バックグラウンドで実処理をキュー（ロックにより1並列実行）
-    background_tasks.add_task(run_download_task, new_id, url, download_type, False, yt_dlp_params)
+    # ダウンロードキューへ投入（DOWNLOAD_CONCURRENCY 個の常駐ワーカーが順に取り出して実行する）
+    await request.app.state.download_queue.put((row["id"], url, download_type, False, yt_dlp_params))
 
     return row_to_dict(row)
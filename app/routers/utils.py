@@ -1,48 +1,75 @@
 from __future__ import annotations
 
+import functools
+import re
 import shlex
+import time
+from collections.abc import Iterable
 from pathlib import Path
-from threading import Lock
 from typing import Any
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import urlsplit
 
 from fastapi import HTTPException, status
 from yt_dlp import YoutubeDL
 
+from app.broadcast import publish_threadsafe
 from app.cli_to_api import cli_to_api
-from app.db import DOWNLOADS_DIR, get_connection
-
-# 並列制御用のロック（同時に1つだけ実行）
-_DOWNLOAD_LOCK = Lock()
+from app.db import DOWNLOADS_DIR, pooled_connection
+from app.progress_writer import report_progress
+
+# yt-dlpのデフォルトオプション（ダウンロードごとに浅いコピーして使う）
+_BASE_OPTS: dict[str, Any] = {
+    "noplaylist": True,
+    "quiet": False,
+    "no_warnings": False,
+    # "restrictfilenames": True,
+    "cachedir": False,
+    "no_mtime": True,
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36",
+    "outtmpl": str(DOWNLOADS_DIR / "%(title).150B [%(id)s].%(ext)s"),
+    "add_header": ["Accept-Language: ja-JP"],
+}
+# 音声のみの場合に追加するオプション
+_AUDIO_OPTS: dict[str, Any] = {
+    "format": "bestaudio/best",
+    "postprocessors": [
+        {
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": "mp3",
+            "preferredquality": "320",
+        }
+    ],
+}
+
+# ダウンロード中の進捗を報告する最小間隔（秒）。進捗率が変わらない間は報告せず、100%到達時と完了時は常に報告する
+_PROGRESS_INTERVAL = 0.5
+
+# http(s):// に続いてホスト部が空でない、空白を含まないURL
+_HTTP_URL_RE = re.compile(r"https?://[^\s/?#]+\S*", re.IGNORECASE)
+
+
+# クエリに空でない list= パラメータがあるか
+_PLAYLIST_QUERY_RE = re.compile(r"(?:^|&)list=[^&]")
 
 
 # シンプルなロジック、URLに「list=」クエリや「/playlist」パスが含まれている場合はプレイリストとみなす
+# 同じURLの再登録も多いため、判定結果をキャッシュする
+@functools.lru_cache(maxsize=1024)
 def _is_playlist_url(url: str) -> bool:
     try:
-        parsed = urlparse(url)
-    except Exception:
+        parsed = urlsplit(url)
+    except ValueError:
         return False
-    qs = parse_qs(parsed.query)
-    if qs.get("list"):
+    if _PLAYLIST_QUERY_RE.search(parsed.query):
         return True
-    return bool(parsed.path and "playlist" in parsed.path)
+    return "playlist" in parsed.path
 
 
-def validate_download_type(download_type: str) -> None:
-    if download_type not in {"video", "audio"}:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="download_type は 'video' または 'audio' を指定してください。",
-        )
+def is_http_url(url: str) -> bool:
+    return _HTTP_URL_RE.fullmatch(url) is not None
 
 
-def validate_url(url: str) -> None:
-    parsed = urlparse(url)
-    if parsed.scheme not in {"http", "https"} or not parsed.netloc:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="URLが不正です。http(s):// で始まる有効なURLを指定してください。",
-        )
+def validate_not_playlist(url: str) -> None:
     if _is_playlist_url(url):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -50,24 +77,21 @@ def validate_url(url: str) -> None:
         )
 
 
+# APIで返すカラム（SELECT * を避けて必要な列だけ取得する）
+DOWNLOAD_COLUMNS = "id, url, title, status, download_type, file_size, progress, file_path, error_message, yt_dlp_params, created_at, updated_at"
+
+
+_DOWNLOAD_COLUMN_NAMES = tuple(DOWNLOAD_COLUMNS.split(", "))
+
+
 def row_to_dict(row: Any) -> dict[str, Any]:
-    # sqlite3.Rowはdict-likeだがdictではないので、キーの存在チェックが必要
-    # DBカラム追加時にKeyErrorを防ぐため、yt_dlp_paramsのみ存在チェック
-    keys = row.keys()
-    return {
-        "id": row["id"],
-        "url": row["url"],
-        "title": row["title"],
-        "status": row["status"],
-        "download_type": row["download_type"],
-        "file_size": row["file_size"],
-        "progress": row["progress"],
-        "file_path": row["file_path"],
-        "error_message": row["error_message"],
-        "yt_dlp_params": row["yt_dlp_params"] if "yt_dlp_params" in keys else None,
-        "created_at": row["created_at"],
-        "updated_at": row["updated_at"],
-    }
+    # DOWNLOAD_COLUMNS で取得した sqlite3.Row をそのままdict化する（列名がキーになる）
+    return dict(row)
+
+
+def rows_to_dicts(rows: Iterable[Any]) -> list[dict[str, Any]]:
+    # 一覧用。列順が DOWNLOAD_COLUMNS と決まっているので、列名と値をzipする（dict(row)より約2倍速い）
+    return [dict(zip(_DOWNLOAD_COLUMN_NAMES, row, strict=True)) for row in rows]
 
 
 def run_download_task(
@@ -77,50 +101,36 @@ def run_download_task(
     force_redownload: bool = False,
     yt_dlp_params: str | None = None,
 ) -> None:
-    """Background download task serialized to run 1 at a time.
+    """Download task run by one of the DOWNLOAD_CONCURRENCY queue workers.
 
     - ステータス/進捗/サイズ/ファイルパス/エラーをDBに反映
-    - 既存ファイルがある場合はスキップしてcompletedにする
+    - 既存ファイルがある場合はyt-dlpがダウンロードをスキップし、completedにする（強制再DL時は上書き）
     - プレイリストは事前バリデーションで弾かれている想定
     """
     last_filename: str | None = None
     final_path: str | None = None
+    last_report = 0.0
+    last_progress = -1
+    last_size = 0
 
-    def _update_sql(query: str, params: tuple[Any, ...]) -> None:
-        with get_connection() as conn_u:
-            conn_u.execute(query, params)
-            conn_u.commit()
+    # 状態更新用のコネクションはプールから借り、タスク中1本を使い回す（終了時にプールへ戻す）
+    with pooled_connection() as conn:
+
+        def _update_sql(query: str, params: tuple[Any, ...]) -> None:
+            conn.execute(query, params)
+            conn.commit()
+            publish_threadsafe(download_id)
 
-    # 並列ロックで囲む（同時実行を防ぐ）
-    with _DOWNLOAD_LOCK:
         # downloadingに変更
         _update_sql(
             "UPDATE downloads SET status = 'downloading', progress = 0, error_message = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
             (download_id,),
         )
         try:
-            # yt-dlpのデフォルトオプション
-            default_opts: dict[str, Any] = {
-                "noplaylist": True,
-                "quiet": False,
-                "no_warnings": False,
-                # "restrictfilenames": True,
-                "overwrites": bool(force_redownload),
-                "cachedir": False,
-                "no_mtime": True,
-                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36",
-                "outtmpl": str(DOWNLOADS_DIR / "%(title).150B [%(id)s].%(ext)s"),
-                "add_header": ["Accept-Language: ja-JP"],
-            }
+            # yt-dlpのデフォルトオプション（定数を浅くコピーし、タスクごとの値だけ設定する）
+            default_opts: dict[str, Any] = {**_BASE_OPTS, "overwrites": bool(force_redownload)}
             if download_type == "audio":
-                default_opts["format"] = "bestaudio/best"
-                default_opts["postprocessors"] = [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                        "preferredquality": "320",
-                    }
-                ]
+                default_opts.update(_AUDIO_OPTS)
 
             # ユーザー指定の追加パラメータを反映
             user_opts: dict[str, Any] = {}
@@ -136,44 +146,13 @@ def run_download_task(
                     ) from e
 
             # デフォルトオプションとユーザー指定オプションをマージ
-            download_opts = dict(default_opts)
-            download_opts.update(user_opts)
-
-            # メタ情報と期待されるファイル名を先に取得
-            with YoutubeDL(download_opts) as ydl_probe:
-                info_probe = ydl_probe.extract_info(url, download=False)
-                title = info_probe.get("title") if isinstance(info_probe, dict) else None
-                if title:
-                    _update_sql(
-                        "UPDATE downloads SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                        (title, download_id),
-                    )
-                expected_path = Path(ydl_probe.prepare_filename(info_probe))
-
-            # 既にファイルが存在する場合の挙動
-            if expected_path.exists():
-                if not force_redownload:
-                    # 強制再DLでなければスキップしてcompletedに
-                    try:
-                        size = expected_path.stat().st_size
-                    except OSError:
-                        size = 0
-                    _update_sql(
-                        "UPDATE downloads SET status = 'completed', file_path = ?, file_size = ?, progress = 100, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                        (str(expected_path), int(size), download_id),
-                    )
-                    return
-                else:
-                    # 再試行(強制)時は既存ファイルを削除して最初からやり直す
-                    try:
-                        expected_path.unlink()
-                    except OSError:
-                        pass
+            # default_opts はタスクごとのコピーなので、そのまま上書きして使う
+            default_opts.update(user_opts)
 
             # 進捗フック
             def _hook(d: dict[str, Any]) -> None:
                 # yt-dlpの進捗情報をDBに反映
-                nonlocal last_filename
+                nonlocal last_filename, last_report, last_progress, last_size
                 st = d.get("status")
                 if st == "downloading":
                     # ダウンロード中: 進捗率・ファイルサイズを更新
@@ -181,31 +160,34 @@ def run_download_task(
                     downloaded = d.get("downloaded_bytes") or 0
                     progress = 0
                     if total:
-                        try:
-                            progress = int(max(0, min(100, (downloaded * 100) // total)))
-                        except Exception:
-                            progress = 0
+                        # 0〜100に丸める（totalは0以外なので除算は失敗しない）
+                        progress = int(downloaded * 100 // total)
+                        progress = 100 if progress > 100 else (0 if progress < 0 else progress)
                     filename = d.get("filename") or last_filename
                     if filename:
                         last_filename = filename
-                    _update_sql(
-                        "UPDATE downloads SET progress = ?, file_size = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                        (int(progress), int(total or 0), download_id),
-                    )
+                    # 進捗は間引いて書き込み待ちに積む（ライターがまとめてDBへ反映する）
+                    # 進捗率(%)が変わっていない間は報告しない
+                    now = time.monotonic()
+                    if progress >= 100 or (progress != last_progress and now - last_report >= _PROGRESS_INTERVAL):
+                        last_report = now
+                        last_progress = progress
+                        report_progress(download_id, int(progress), int(total or 0))
                 elif st == "finished":
                     # ダウンロード完了: ファイルサイズ・進捗100%を更新
                     filename = d.get("filename") or last_filename
                     if filename:
                         last_filename = filename
-                        try:
-                            size = Path(filename).stat().st_size
-                        except OSError:
-                            size = 0
-                        # ファイルパスは最後にexpected_pathで上書きするので、ここではサイズと進捗のみ更新
-                        _update_sql(
-                            "UPDATE downloads SET file_size = ?, progress = 100, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                            (int(size), download_id),
-                        )
+                        # サイズはフックの値を使い、取れない場合だけstatする
+                        size = d.get("total_bytes") or d.get("downloaded_bytes") or 0
+                        if not size:
+                            try:
+                                size = Path(filename).stat().st_size
+                            except OSError:
+                                size = 0
+                        last_size = int(size)
+                        # ファイルパスは完了時にポストプロセッサーフックで得た final_path を書き込むので、ここではサイズと進捗のみ更新
+                        report_progress(download_id, 100, last_size)
 
             # ポストプロセッサフック
             def _postprocessor_hook(d: dict[str, Any]) -> None:
@@ -215,27 +197,38 @@ def run_download_task(
                     # ポストプロセッサ完了: 最終ファイル名を取得
                     final_path = d.get("info_dict", {}).get("filepath")
 
-            run_opts = dict(download_opts)
-            run_opts["progress_hooks"] = [_hook]
-            run_opts["postprocessor_hooks"] = [_postprocessor_hook]
+            default_opts["progress_hooks"] = [_hook]
+            default_opts["postprocessor_hooks"] = [_postprocessor_hook]
 
-            # 実ダウンロード
-            with YoutubeDL(run_opts) as ydl_run:
-                ydl_run.extract_info(url, download=True)
+            # 1つのYoutubeDLでメタ情報取得と実ダウンロードを行う（抽出器やポストプロセッサの初期化を1回で済ませる）
+            # 既存ファイルの扱いはyt-dlpに任せる（overwrites=Falseならスキップ、強制再DL時は上書き）
+            with YoutubeDL(default_opts) as ydl:
+                # タイトルはダウンロード開始前に反映する
+                info = ydl.extract_info(url, download=False)
+                title = info.get("title") if isinstance(info, dict) else None
+                if title:
+                    _update_sql(
+                        "UPDATE downloads SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                        (title, download_id),
+                    )
+                # 実ダウンロード（取得済みのメタ情報を使い、抽出をやり直さない）
+                ydl.process_ie_result(info, download=True)
 
             # 完了時にDBへ最終情報を反映
-            try:
-                size = Path(final_path).stat().st_size
-            except OSError:
-                size = 0
+            # 後処理でファイルが変わっていなければダウンロード時のサイズをそのまま使う（変換・結合時はstatする）
+            if last_size and final_path == last_filename:
+                size = last_size
+            else:
+                try:
+                    size = Path(final_path).stat().st_size
+                except OSError:
+                    size = 0
             _update_sql(
                 "UPDATE downloads SET status = 'completed', file_path = ?, file_size = ?, progress = 100, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
                 (str(final_path), int(size), download_id),
             )
         except Exception as e:
-            msg = str(e)
-            if len(msg) > 500:
-                msg = msg[:500]
+            msg = str(e)[:500]
             _update_sql(
                 "UPDATE downloads SET status = 'error', error_message = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
                 (msg, download_id),
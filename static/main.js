@@ -27,62 +27,127 @@ function statusBadgeClass(s) {
   }
 }
 
-function escapeHtml(s) {
-  return (s ?? "")
-    .toString()
-    .replaceAll("&", "&")
-    .replaceAll("<", "<")
-    .replaceAll(">", ">");
+// FastAPIのエラー応答からメッセージを取り出す（入力検証エラーはdetailが配列になる）
+function errorMessage(body, fallback) {
+  const detail = body?.detail;
+  if (Array.isArray(detail)) {
+    return detail.map((d) => d.msg).join("\n") || fallback;
+  }
+  return detail ?? fallback;
+}
+
+// 値が変わったときだけDOMへ書き込む（同値の再設定でもレイアウトが走るため）
+function setText(el, text) {
+  if (el.textContent !== text) el.textContent = text;
 }
 
-function renderRows(items) {
+function setAttr(el, name, value) {
+  if (el.getAttribute(name) !== value) el.setAttribute(name, value);
+}
+
+// 表示中の行（id -> tr）。SSEで届いた変更は該当行のセルだけを更新する
+const rowsById = new Map();
+
+function createRow(id) {
+  const tr = $("#rowTpl").content.firstElementChild.cloneNode(true);
+  tr.dataset.id = String(id);
+  // 新しい順（id降順）を保つ位置に挿入する
   const tbody = $("#historyBody");
-  if (!Array.isArray(items)) items = [];
-  tbody.innerHTML = items
-    .map((item) => {
-      const prog = Math.max(0, Math.min(100, Number(item.progress || 0)));
-      const size = fmtBytes(Number(item.file_size || 0));
-      const title = item.title
-        ? escapeHtml(item.title)
-        : '<span class="text-gray-500">(未取得)</span>';
-      const err = item.error_message
-        ? '<div class="text-red-700">' + escapeHtml(item.error_message) + "</div>"
-        : "";
-      const canSave = item.status === "completed" && item.file_path;
-      const canRetry = item.status !== "downloading";
-      const retryTitle = item.yt_dlp_params
-        ? escapeHtml(item.yt_dlp_params)
-        : canRetry
-          ? "再試行"
-          : "ダウンロード中は不可";
-      return `
-          <tr data-id="${item.id}">
-            <td><span class="${statusBadgeClass(item.status)}">${escapeHtml(item.status)}</span></td>
-            <td class="title-cell">${title}<div class="text-xs text-gray-500">${escapeHtml(item.url)}</div></td>
-            <td class="whitespace-nowrap">${escapeHtml(item.download_type)}</td>
-            <td class="whitespace-nowrap">${size}</td>
-            <td class="whitespace-nowrap">
-              <div class="w-32 h-2 bg-gray-200 rounded-md overflow-hidden" title="${prog}%">
-                <span class="block h-full bg-blue-500 transition-all" style="width:${prog}%"></span>
-              </div>
-            </td>
-            <td>${err}</td>
-            <td class="whitespace-nowrap">
-              <button class="btn btn-save inline-flex items-center justify-center gap-1.5 px-3 py-1.5 rounded-md border border-green-300 text-green-700 bg-green-50 hover:bg-green-100 text-sm font-semibold disabled:opacity-50 disabled:cursor-not-allowed" ${canSave ? "" : "disabled"} title="${canSave ? "保存" : "ダウンロード未完了"}">保存</button>
-              <button class="btn btn-retry inline-flex items-center justify-center gap-1.5 px-3 py-1.5 rounded-md border border-blue-300 text-blue-800 bg-blue-50 hover:bg-blue-100 text-sm font-semibold disabled:opacity-50 disabled:cursor-not-allowed" ${canRetry ? "" : "disabled"} title="${retryTitle}">再試行</button>
-            </td>
-          </tr>
-        `;
-    })
-    .join("");
+  let next = null;
+  for (const row of tbody.rows) {
+    if (Number(row.dataset.id) < id) {
+      next = row;
+      break;
+    }
+  }
+  tbody.insertBefore(tr, next);
+  rowsById.set(id, tr);
+  return tr;
+}
+
+// ダウンロード中以外は再試行できる
+function canRetryStatus(status) {
+  return status !== "downloading";
+}
+
+function updateRow(tr, item) {
+  const prog = Math.max(0, Math.min(100, Number(item.progress || 0)));
+  const status = tr.querySelector(".row-status");
+  setText(status, item.status ?? "");
+  setAttr(status, "class", "row-status " + statusBadgeClass(item.status));
+
+  const title = tr.querySelector(".row-title");
+  setText(title, item.title || "(未取得)");
+  title.classList.toggle("text-gray-500", !item.title);
+  setText(tr.querySelector(".row-url"), item.url ?? "");
+  setText(tr.querySelector(".row-type"), item.download_type ?? "");
+  setText(tr.querySelector(".row-size"), fmtBytes(Number(item.file_size || 0)));
+
+  const progress = tr.querySelector(".row-progress");
+  setAttr(progress, "title", prog + "%");
+  const bar = progress.firstElementChild;
+  if (bar.style.width !== prog + "%") bar.style.width = prog + "%";
+
+  setText(tr.querySelector(".row-error"), item.error_message ?? "");
+
+  const canSave = item.status === "completed" && Boolean(item.file_path);
+  const canRetry = canRetryStatus(item.status);
+  const save = tr.querySelector(".btn-save");
+  save.disabled = !canSave;
+  setAttr(save, "title", canSave ? "保存" : "ダウンロード未完了");
+  const retry = tr.querySelector(".btn-retry");
+  retry.disabled = !canRetry;
+  setAttr(
+    retry,
+    "title",
+    item.yt_dlp_params || (canRetry ? "再試行" : "ダウンロード中は不可"),
+  );
+}
+
+function applyChanges(items) {
+  for (const item of items) {
+    updateRow(rowsById.get(item.id) ?? createRow(item.id), item);
+  }
+}
+
+function clearRows() {
+  rowsById.clear();
+  $("#historyBody").replaceChildren();
+}
+
+// 一覧は新しい順に1ページずつ取得する（続きは「さらに読み込む」で前ページの最小IDより古いものを取得）
+const PAGE_SIZE = 50;
+let oldestId = null;
+
+async function fetchPage(beforeId) {
+  const params = new URLSearchParams({ limit: String(PAGE_SIZE) });
+  if (beforeId !== null) params.set("before_id", String(beforeId));
+  const res = await fetch("/api/downloads?" + params);
+  if (!res.ok) throw new Error("一覧取得に失敗しました");
+  const data = await res.json();
+  const items = Array.isArray(data) ? data : [];
+  if (items.length > 0) oldestId = items[items.length - 1].id;
+  $("#loadMoreBtn").style.display =
+    items.length < PAGE_SIZE ? "none" : "inline-flex";
+  return items;
 }
 
 async function fetchHistory() {
   try {
-    const res = await fetch("/api/downloads");
-    if (!res.ok) throw new Error("一覧取得に失敗しました");
-    const data = await res.json();
-    renderRows(data);
+    const items = await fetchPage(null);
+    clearRows();
+    applyChanges(items);
+  } catch (e) {
+    console.error(e);
+  }
+}
+
+async function loadMore() {
+  if (oldestId === null) return;
+  try {
+    // 既に表示中の行はSSEで最新に保たれているため、古い取得結果で上書きしない
+    const items = await fetchPage(oldestId);
+    applyChanges(items.filter((item) => !rowsById.has(item.id)));
   } catch (e) {
     console.error(e);
   }
@@ -101,28 +166,34 @@ async function registerDownload(url, download_type, yt_dlp_params) {
     if (!res.ok) {
       const body = await res.json().catch(() => ({}));
       throw new Error(
-        body.detail ?? "登録に失敗しました (HTTP " + res.status + ")",
+        errorMessage(body, "登録に失敗しました (HTTP " + res.status + ")"),
       );
     }
-    await fetchHistory();
+    // 表示中の行はSSEで届く最新の状態を優先する（応答の方が遅れて届くと古い状態に戻るため）
+    const item = await res.json();
+    if (!rowsById.has(item.id)) applyChanges([item]);
   } catch (e) {
     errBox.textContent = e.message || String(e);
     errBox.style.display = "block";
   }
 }
 
+// 成功したらtrueを返す（行の更新はSSEで届く）
 async function retryDownload(id) {
   try {
     const res = await fetch(`/api/downloads/${id}/retry`, { method: "POST" });
     if (!res.ok) {
       const body = await res.json().catch(() => ({}));
       throw new Error(
-        body.detail ?? "再試行に失敗しました (HTTP " + res.status + ")",
+        errorMessage(body, "再試行に失敗しました (HTTP " + res.status + ")"),
       );
     }
-    await fetchHistory();
+    const item = await res.json();
+    if (!rowsById.has(item.id)) applyChanges([item]);
+    return true;
   } catch (e) {
     alert(e.message || String(e));
+    return false;
   }
 }
 
@@ -134,10 +205,11 @@ document.getElementById("historyBody").addEventListener("click", async (e) => {
   const id = Number(tr.dataset.id);
   if (btn.classList.contains("btn-retry")) {
     btn.disabled = true;
-    try {
-      await retryDownload(id);
-    } finally {
-      btn.disabled = false;
+    // 成功時のボタン状態はSSEで届く行の更新に任せ、失敗時だけ現在の状態に戻す
+    if (!(await retryDownload(id))) {
+      btn.disabled = !canRetryStatus(
+        tr.querySelector(".row-status").textContent,
+      );
     }
   } else if (btn.classList.contains("btn-save")) {
     // 保存ボタンがクリックされたときの処理
@@ -175,6 +247,15 @@ $("#startBtn").addEventListener("click", async () => {
   }
 });
 
+$("#loadMoreBtn").addEventListener("click", async () => {
+  $("#loadMoreBtn").disabled = true;
+  try {
+    await loadMore();
+  } finally {
+    $("#loadMoreBtn").disabled = false;
+  }
+});
+
 // 偽装ボタン
 const impersonateBtn = document.getElementById("impersonateBtn");
 if (impersonateBtn) {
@@ -190,6 +271,28 @@ if (impersonateBtn) {
   });
 }
 
-// 初期表示とポーリング（進捗や状態の自動更新のため）
-fetchHistory();
-setInterval(fetchHistory, 2000);
+// 変更通知を購読し、購読開始（ready）のたびに一覧を取り直す（初回・再接続時とも）
+// 取得中に届いた変更はバッファし、一覧の描画後に適用する（行全体が届くので再適用しても問題ない）
+let bufferedChanges = null;
+let syncing = Promise.resolve();
+
+function resync() {
+  syncing = syncing.then(async () => {
+    bufferedChanges = [];
+    try {
+      await fetchHistory();
+    } finally {
+      const buffered = bufferedChanges;
+      bufferedChanges = null;
+      for (const items of buffered) applyChanges(items);
+    }
+  });
+}
+
+const events = new EventSource("/api/downloads/stream");
+events.addEventListener("ready", resync);
+events.addEventListener("message", (e) => {
+  const items = JSON.parse(e.data);
+  if (bufferedChanges) bufferedChanges.push(items);
+  else applyChanges(items);
+});
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from app import db
+
+
+@pytest.fixture
+def temp_db(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """DBと保存先を一時ディレクトリに向ける。"""
+    monkeypatch.setattr(db, "DATA_DIR", tmp_path / "data")
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "data" / "webui.db")
+    monkeypatch.setattr(db, "DOWNLOADS_DIR", tmp_path / "downloads")
+    return db.DB_PATH
+
+
+def test_get_connection_uses_wal_and_busy_timeout(temp_db: Path) -> None:
+    """init_db() 後の接続がWALモードで、busy_timeout が設定されていること。"""
+    asyncio.run(db.init_db())
+    assert temp_db.exists()
+
+    conn = db.get_connection()
+    try:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 30000
+    finally:
+        conn.close()